@@ -0,0 +1,536 @@
+"""Shared translation pipeline for translate_chapters.py / translate_to_ja.py.
+
+Both scripts used to carry near-identical copies of the chunking,
+placeholder-protection, and translation code, so every fix had to be
+applied twice. The pipeline lives here once; the scripts keep only
+their directory layout and per-file driver logic.
+"""
+import asyncio
+import atexit
+import functools
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from deep_translator import GoogleTranslator
+except Exception:
+    print("ERROR: deep_translator is not installed. Install with: pip install deep-translator", file=sys.stderr)
+    sys.exit(1)
+
+try:
+    import aiohttp
+except Exception:
+    aiohttp = None  # fall back to serial translation
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except Exception:
+    requests = None  # deep-translator pulls it in; guard just in case
+
+
+# Same endpoint deep-translator talks to; posting ourselves lets us run
+# all chunks of a file concurrently instead of one round-trip at a time.
+GOOGLE_ENDPOINT = 'https://translate.googleapis.com/translate_a/single'
+MAX_CONCURRENCY = 16
+
+# Files are translated in parallel; bounded so we don't hammer the API.
+MAX_WORKERS = int(os.environ.get('TRANSLATE_WORKERS', '8'))
+
+# Google accepts ~5000 chars per request; 4500 keeps a safety margin
+# while packing far fewer HTTP calls than the old 800-char chunks.
+DEFAULT_MAX_CHARS = int(os.environ.get('TRANSLATE_MAX_CHARS', '4500'))
+
+# Transient 429/5xx responses are retried with exponential backoff
+# before giving up, so a single throttled request doesn't silently
+# leave untranslated source text in the output.
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+
+# Source bytes are read ahead by a small pool so disk I/O overlaps the
+# HTTP translation of earlier files; the window bounds memory use.
+PREFETCH_WORKERS = 4
+PREFETCH_DEPTH = 8
+
+
+def iter_file_bytes(paths, workers=PREFETCH_WORKERS, depth=PREFETCH_DEPTH):
+    # Yield (path, raw bytes) in order, reading up to `depth` files
+    # ahead in background threads. A failed read yields the exception
+    # in place of the bytes so callers can report it.
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        it = iter(paths)
+        window = deque()
+
+        def submit_next():
+            for p in it:
+                window.append((p, ex.submit(p.read_bytes)))
+                break
+
+        for _ in range(depth):
+            submit_next()
+        while window:
+            path, fut = window.popleft()
+            submit_next()
+            try:
+                data = fut.result()
+            except Exception as e:
+                data = e
+            yield path, data
+
+
+def _install_session_pooling():
+    # Point deep-translator's google module at one pooled keep-alive
+    # session; otherwise every translate call pays a fresh TLS setup.
+    # A Session exposes the same get/post API the module calls.
+    if requests is None:
+        return
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=MAX_CONCURRENCY,
+                          pool_maxsize=MAX_CONCURRENCY, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    for name in ('deep_translator.google', 'deep_translator.google_trans'):
+        try:
+            mod = importlib.import_module(name)
+        except Exception:
+            continue
+        if getattr(mod, 'requests', None) is not None:
+            mod.requests = session
+
+
+_install_session_pooling()
+
+
+def atomic_write_text(path, data):
+    # Write via a temp file + fsync + rename so a crash mid-write can
+    # never leave a truncated file that the manifest skip would trust.
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# Persistent chunk->translation cache so re-runs only hit the API for
+# paragraphs that actually changed.
+CACHE_PATH = Path('.translate_cache.json')
+_cache_lock = threading.Lock()
+
+
+def _load_cache():
+    try:
+        return json.loads(CACHE_PATH.read_text(encoding='utf-8'))
+    except Exception:
+        return {}
+
+
+_cache = _load_cache()
+_cache_dirty = False
+
+
+def _cache_key(target, text):
+    return hashlib.sha1(f"{target}\0{text}".encode('utf-8')).hexdigest()
+
+
+def _save_cache():
+    if _cache_dirty:
+        try:
+            atomic_write_text(CACHE_PATH, json.dumps(_cache, ensure_ascii=False))
+        except Exception as e:
+            print(f"Warning: could not save translation cache: {e}", file=sys.stderr)
+
+
+atexit.register(_save_cache)
+
+# Sidecar manifest of source hashes so unchanged files are skipped
+# entirely on re-runs instead of burning API quota.
+MANIFEST_PATH = Path('.translate_manifest.json')
+_manifest_lock = threading.Lock()
+
+
+def _load_manifest():
+    try:
+        return json.loads(MANIFEST_PATH.read_text(encoding='utf-8'))
+    except Exception:
+        return {}
+
+
+_manifest = _load_manifest()
+
+
+def manifest_matches(dst, src_hash):
+    return _manifest.get(str(dst)) == src_hash
+
+
+def manifest_record(dst, src_hash):
+    with _manifest_lock:
+        _manifest[str(dst)] = src_hash
+
+
+def save_manifest():
+    try:
+        atomic_write_text(MANIFEST_PATH, json.dumps(_manifest, indent=1, sort_keys=True))
+    except Exception as e:
+        print(f"Warning: could not save translation manifest: {e}", file=sys.stderr)
+
+
+async def _translate_one(session, text, target):
+    # POST the chunk as form data: percent-encoded CJK text in a GET
+    # query string is ~9 bytes per character, which blows past URL
+    # length limits (413/414) at full-size chunks.
+    params = {'client': 'gtx', 'sl': 'auto', 'tl': target, 'dt': 't'}
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            # Hold a slot only for the request itself, not the backoff.
+            await _acquire_request_slot()
+            try:
+                async with session.post(GOOGLE_ENDPOINT, params=params, data={'q': text}) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json(content_type=None)
+            finally:
+                _request_slots.release()
+            return ''.join(part[0] for part in data[0] if part and part[0])
+        except Exception:
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+
+# One process-wide cap on in-flight requests. Every file-worker thread
+# runs its own event loop, so a per-session connector limit cannot
+# bound the total regardless of how it is divided up; a shared
+# threading.Semaphore holds the cap for any TRANSLATE_WORKERS value.
+# It is acquired via the loop's executor so a waiting coroutine never
+# blocks the loop that has to keep running for permits to be released.
+_request_slots = threading.Semaphore(MAX_CONCURRENCY)
+
+
+async def _acquire_request_slot():
+    await asyncio.get_running_loop().run_in_executor(None, _request_slots.acquire)
+
+
+async def _translate_all(texts, target):
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [_translate_one(session, t, target) for t in texts]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_local = threading.local()
+
+
+def _get_translator(target):
+    # One translator per thread: GoogleTranslator wraps a requests
+    # session that is not thread-safe.
+    translators = getattr(_local, 'translators', None)
+    if translators is None:
+        translators = _local.translators = {}
+    if target not in translators:
+        translators[target] = GoogleTranslator(source='auto', target=target)
+    return translators[target]
+
+
+@functools.lru_cache(maxsize=4096)
+def _translate_text(target, text):
+    # Dedup repeated chunks within a run (captions, boilerplate lines):
+    # a dict lookup replaces a full network round-trip on every repeat.
+    return _get_translator(target).translate(text)
+
+
+def _translate_with_retry(target, text):
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return _translate_text(target, text)
+        except Exception:
+            if attempt == RETRY_ATTEMPTS - 1:
+                break
+            time.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+    return None
+
+
+def _fetch_once(texts, target):
+    # Hit the network for each text; None marks a failed translation.
+    if aiohttp is not None:
+        try:
+            results = asyncio.run(_translate_all(texts, target))
+        except Exception:
+            results = None  # fall through to serial translation
+        if results is not None:
+            # Chunks the async pass lost (throttled on the gtx endpoint)
+            # still get the deep-translator serial path - a different
+            # client that may succeed - before falling back to source.
+            return [_translate_with_retry(target, t) if isinstance(r, Exception) else r
+                    for t, r in zip(texts, results)]
+    # Ship all inputs through one session instead of per-chunk requests.
+    try:
+        batch = _get_translator(target).translate_batch(list(texts))
+        if batch and len(batch) == len(texts):
+            return list(batch)
+    except Exception:
+        pass  # fall back to per-chunk translation
+    return [_translate_with_retry(target, t) for t in texts]
+
+
+# Below this size a failure is treated as genuinely transient rather
+# than a payload-too-large rejection, and splitting stops.
+_MIN_SPLIT_CHARS = 256
+
+
+def _split_chunk(text):
+    # Split near the midpoint, preferring a paragraph boundary, then a
+    # line break, then a space, before a hard character split.
+    mid = len(text) // 2
+    for sep in ("\n\n", "\n", " "):
+        cut = text.rfind(sep, 1, mid)
+        if cut == -1:
+            cut = text.find(sep, mid, len(text) - 1)
+        if cut != -1:
+            return text[:cut], text[cut + len(sep):], sep
+    return text[:mid], text[mid:], ""
+
+
+def _translate_oversize(target, text):
+    # A payload-too-large rejection (413/414) fails identically on
+    # every transport and every retry; halving the chunk is the only
+    # cure. Recurses through _fetch_translations until halves succeed
+    # or drop under _MIN_SPLIT_CHARS.
+    left, right, sep = _split_chunk(text)
+    if not left or not right:
+        return None
+    halves = _fetch_translations([left, right], target)
+    if halves[0] is None or halves[1] is None:
+        return None
+    return halves[0] + sep + halves[1]
+
+
+def _fetch_translations(texts, target):
+    results = _fetch_once(texts, target)
+    for i, (t, r) in enumerate(zip(texts, results)):
+        if r is None and len(t) >= _MIN_SPLIT_CHARS:
+            results[i] = _translate_oversize(target, t)
+    return results
+
+
+def _translate_chunks(texts, target):
+    # Translate a list of non-empty chunks, falling back to the original
+    # text for any chunk that fails. Cached translations never hit the
+    # network; failures are not cached. Returns (results, ok) where ok
+    # is False if any chunk fell back to its source text.
+    global _cache_dirty
+    results = [None] * len(texts)
+    misses = []
+    ok = True
+    with _cache_lock:
+        for i, t in enumerate(texts):
+            cached = _cache.get(_cache_key(target, t))
+            if cached is not None:
+                results[i] = cached
+            else:
+                misses.append(i)
+    if misses:
+        fetched = _fetch_translations([texts[i] for i in misses], target)
+        with _cache_lock:
+            for i, translated in zip(misses, fetched):
+                if translated is None:
+                    results[i] = texts[i]
+                    ok = False
+                else:
+                    results[i] = translated
+                    _cache[_cache_key(target, texts[i])] = translated
+                    _cache_dirty = True
+    return results, ok
+
+
+def chunk_paragraphs(paragraphs, max_chars=DEFAULT_MAX_CHARS):
+    chunks = []
+    current = []
+    current_len = 0
+    # Precompute lengths once; the +2 accounts for the "\n\n" joiner so
+    # the running total matches the joined chunk size.
+    lens = [len(p) for p in paragraphs]
+    for p, plen in zip(paragraphs, lens):
+        add_len = plen + 2
+        if current and current_len + add_len > max_chars:
+            chunks.append("\n\n".join(current))
+            current = [p]
+            current_len = add_len
+        else:
+            current.append(p)
+            current_len += add_len
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+FENCE_SPLIT_RE = re.compile(r"(?m)^([ \t]*```.*)$")
+INLINE_CODE_RE = re.compile(r"`([^`]+)`")
+ANNO_TARGET_RE = re.compile(r"\(annotation:([^)]+)\)")
+ANNO_BARE_RE = re.compile(r"(?<!\()annotation:([a-z0-9\-]+)")
+
+# Placeholders are ASCII index tokens into a shared list: no dict
+# hashing per match, and restore is a plain list index. The token form
+# keeps the proven survivability of the old __INLINE_CODE_n__ keys -
+# raw control characters are too easily stripped or normalized away in
+# transit, which would silently delete the protected spans.
+PLACEHOLDER_RE = re.compile(r"__PH_(\d+)__")
+
+# Chunks that are nothing but placeholders, whitespace, or markdown
+# punctuation (---, >, list markers): translating them wastes a
+# round-trip and risks the placeholders getting mangled.
+SKIP_CHUNK_RE = re.compile(r"(?:__PH_\d+__|[\s\W_])+")
+
+
+def split_code_segments(content):
+    # Split content into (is_code, text) segments in one C-level regex
+    # pass instead of matching every line in Python. Odd-indexed parts
+    # are the fence lines themselves; prose parts keep their text minus
+    # the newlines that belong to the segment boundaries.
+    parts = FENCE_SPLIT_RE.split(content)
+    segments = []
+    in_code = False
+    for i, part in enumerate(parts):
+        if i % 2:
+            in_code = not in_code
+            segments.append((True, part))
+            continue
+        if part == "" or (i > 0 and part == "\n"):
+            continue
+        if i > 0 and part.startswith("\n"):
+            part = part[1:]
+        if part.endswith("\n"):
+            part = part[:-1]
+        segments.append((in_code, part))
+    return segments
+
+
+def _make_repl(store):
+    counter = itertools.count(len(store))
+
+    def repl(m):
+        store.append(m.group(0))
+        return f"__PH_{next(counter)}__"
+    return repl
+
+
+def protect_inline_code(text, store=None):
+    # `store` lets several protect passes share one numbering space.
+    if store is None:
+        store = []
+    return INLINE_CODE_RE.sub(_make_repl(store), text), store
+
+
+def protect_annotation_targets(text, store=None):
+    if store is None:
+        store = []
+    repl = _make_repl(store)
+    text = ANNO_TARGET_RE.sub(repl, text)
+    text = ANNO_BARE_RE.sub(repl, text)
+    return text, store
+
+
+def restore_inline_code(text, store):
+    # One linear scan over the text instead of one str.replace per key.
+    def repl(m):
+        i = int(m.group(1))
+        return store[i] if i < len(store) else m.group(0)
+    return PLACEHOLDER_RE.sub(repl, text)
+
+
+def slug_to_title(slug: str) -> str:
+    # Convert slugs like 'computational-equivalence' to 'Computational Equivalence'
+    return slug.replace('-', ' ').strip().title()
+
+
+_BRACKETED_ANNO_RE = re.compile(r"\[annotation:\s*([a-z0-9\-]+)\]")
+_BRACKET_SPACE_RE = re.compile(r"\]\s+\(")
+_ANNO_SPACE_RE = re.compile(r"\(annotation:\s*([a-z0-9\-]+)\)")
+_BARE_ANNO_RE = re.compile(r"(?<!\()annotation:\s*([a-z0-9\-]+)")
+
+
+def _repl_annotation_link(m):
+    slug = m.group(1).strip()
+    title = slug_to_title(slug)
+    return f"[{title}](annotation:{slug})"
+
+
+def normalize_annotations(md: str) -> str:
+    # Fix patterns like: [annotation: slug] -> [Title](annotation:slug)
+    md = _BRACKETED_ANNO_RE.sub(_repl_annotation_link, md)
+
+    # Remove stray spaces between link text and target: "] (" -> "]("
+    md = _BRACKET_SPACE_RE.sub("](", md)
+
+    # Normalize spaces inside annotation links: (annotation: slug) -> (annotation:slug)
+    md = _ANNO_SPACE_RE.sub(r"(annotation:\1)", md)
+
+    # Convert stray 'annotation:slug' mentions into links when not already in '(annotation:slug)'
+    md = _BARE_ANNO_RE.sub(_repl_annotation_link, md)
+
+    return md
+
+
+def translate_markdown(content: str, target: str, protect_annotations: bool = False):
+    # Returns (translated, ok). ok is False when any chunk exhausted its
+    # retries and fell back to source text, so callers can avoid marking
+    # the file as done and re-runs get a chance to heal it.
+    ok = True
+
+    # Split content into segments: code-fenced blocks vs normal text
+    segments = split_code_segments(content)
+
+    # Accumulate into one write buffer instead of a list of segment
+    # strings joined at the end.
+    buf = io.StringIO()
+    first = True
+    for is_code, seg in segments:
+        if not first:
+            buf.write("\n")
+        first = False
+        if is_code:
+            buf.write(seg)
+            continue
+        # Protect inline code (and optionally annotation targets) once
+        # for the whole segment, translate the chunked paragraphs, then
+        # restore placeholders in one pass over the joined translation.
+        # Restoring per paragraph was fragile: the translator sometimes
+        # collapses or expands blank lines, which shifted the
+        # placeholder/paragraph pairing.
+        prot_seg, placeholders = protect_inline_code(seg)
+        if protect_annotations:
+            prot_seg, placeholders = protect_annotation_targets(prot_seg, placeholders)
+        chunks = chunk_paragraphs(prot_seg.split("\n\n"))
+        translated_chunks = []
+        pending = []  # (index, text) for chunks that need the network
+        for idx, ch in enumerate(chunks):
+            text = ch.strip()
+            if text and SKIP_CHUNK_RE.fullmatch(text):
+                translated_chunks.append(ch)
+                continue
+            translated_chunks.append(text)
+            if text:
+                pending.append((idx, text))
+        if pending:
+            results, chunks_ok = _translate_chunks([t for _, t in pending], target)
+            if not chunks_ok:
+                ok = False
+            for (idx, _), translated in zip(pending, results):
+                translated_chunks[idx] = translated
+        buf.write(restore_inline_code("\n\n".join(translated_chunks), placeholders))
+
+    return buf.getvalue(), ok